@@ -18,17 +18,38 @@ Features:
 - Duration limit: 3 hours
 - Basic queue/concurrency limit to avoid server overload
 - /cleanup deletes downloaded files
+- Scan results cached per link (10 min) -> repeat pastes are instant
+- Webhook mode when WEBHOOK_URL is set (else long polling)
 """
 
 import os
 import re
+import json
+import logging
+import sqlite3
 import time
 import shutil
 import threading
-from collections import deque
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
+import requests
 import telebot
 import yt_dlp
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.util.retry import Retry
+from telebot import apihelper
+
+# own handler (not basicConfig): telebot already prints its logger itself
+logger = logging.getLogger("gohar-dl")
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+logger.addHandler(_log_handler)
+logger.setLevel(logging.INFO)
 
 # =======================
 # ENV / SETTINGS
@@ -37,32 +58,76 @@ TOKEN = os.environ.get("BOT_TOKEN", "").strip()
 if ":" not in TOKEN:
     raise ValueError("Token must contain a colon")
 
+# public base url (e.g. https://<app>.up.railway.app) -> webhook mode; empty -> polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip().rstrip("/")
+PORT = int(os.environ.get("PORT", "8080"))
+
 DOWNLOAD_DIR = "downloads"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 MAX_DURATION_SEC = 3 * 60 * 60
 MIN_QUALITY_P = 480
 MAX_FILE_MB = 1800
+UPLOAD_BUFFER_BYTES = 1 << 20
 
 # progress edit throttling
 PROGRESS_EDIT_SECONDS = 2
 
-# concurrency control
-MAX_ACTIVE_JOBS = 2
-_active_sem = threading.BoundedSemaphore(MAX_ACTIVE_JOBS)
+# extract_info cache (repeat pastes skip yt-dlp network scan)
+INFO_CACHE_TTL_SEC = 10 * 60
+INFO_CACHE_MAX = 256
+TRACKING_PARAMS = ("si", "feature")
+YOUTUBE_HOSTS = frozenset({"youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com", "youtu.be"})
+# info keys nothing here reads (big on YouTube: captions in ~100 languages)
+INFO_DROP_KEYS = ("automatic_captions", "subtitles", "thumbnails", "heatmap", "description")
+
+# parallel fragment fetches per HLS/DASH download
+FRAGMENT_THREADS = 4
 
-# simple FIFO queue
-_queue = deque()
-_queue_lock = threading.Lock()
-_queue_worker_started = False
+# yt-dlp cache (player JS, signature functions), shared by all threads
+YDL_CACHE_DIR = "/var/tmp/ytdlp-cache"
+# scanned once at boot -> player JS is fetched/parsed before the first user link
+PREWARM_URL = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
 
-bot = telebot.TeleBot(TOKEN, parse_mode=None)
+# concurrency control
+MAX_ACTIVE_JOBS = 2
+# telebot handler workers: a slow scan/upload in one chat doesn't stall the others
+HANDLER_THREADS = 8
+# concurrent link scans (I/O bound, handlers don't wait on them)
+SCAN_THREADS = 16
+
+# download jobs: FIFO, at most MAX_ACTIVE_JOBS running
+POOL = ThreadPoolExecutor(max_workers=MAX_ACTIVE_JOBS, thread_name_prefix="dl")
+# scans (extract_info) run here, apart from downloads so they never queue behind one
+SCAN_POOL = ThreadPoolExecutor(max_workers=SCAN_THREADS, thread_name_prefix="scan")
+# HEAD requests for formats without a size estimate (run in parallel per scan)
+PROBE_THREADS = 8
+PROBE_TIMEOUT_SEC = 5
+PROBE_POOL = ThreadPoolExecutor(max_workers=PROBE_THREADS, thread_name_prefix="probe")
+
+bot = telebot.TeleBot(TOKEN, parse_mode=None, num_threads=HANDLER_THREADS)
 URL_RE = re.compile(r"(https?://\S+)", re.IGNORECASE)
+YT_ID_RE = re.compile(r"(?:v=|youtu\.be/|shorts/|embed/|live/)([A-Za-z0-9_-]{11})")
 
-# per-message state (chat_id, msg_id) -> dict
-STATE = {}
+# per-message state (chat_id, msg_id) -> Session, LRU-bounded + expiring
+MAX_SESSIONS = 10000
+SESSION_TTL_SEC = 30 * 60
+# optional sqlite file (e.g. on a Railway volume): sessions survive restarts and
+# are shared by workers using the same file; empty -> memory only
+STATE_DB = os.environ.get("STATE_DB", "").strip()
+STATE = OrderedDict()
+_state_lock = threading.Lock()
 
 SUPPORTED_HINT = "YouTube | TikTok | Instagram | Facebook | X (Public links)"
+# links on other hosts are refused before yt-dlp spends seconds probing them
+# (subdomains match too: m.youtube.com, vm.tiktok.com, ...)
+SUPPORTED_DOMAINS = frozenset({
+    "youtube.com", "youtu.be",
+    "tiktok.com",
+    "instagram.com",
+    "facebook.com", "fb.com", "fb.watch",
+    "x.com", "twitter.com",
+})
 
 # =======================
 # Helpers
@@ -89,19 +154,29 @@ def progress_bar(pct: float) -> str:
     filled = max(0, min(10, filled))
     return "▰" * filled + "▱" * (10 - filled)
 
+QUALITY_BUCKETS = (144, 240, 360, 480, 720, 1080, 1440, 2160)
+
 def pick_bucket(height):
     if not height:
         return None
-    common = [144, 240, 360, 480, 720, 1080, 1440, 2160]
-    for q in common:
-        if height <= q:
-            return q
-    return 2160
+    i = bisect_left(QUALITY_BUCKETS, height)
+    return QUALITY_BUCKETS[i] if i < len(QUALITY_BUCKETS) else 2160
 
 def clean_downloads():
-    if os.path.exists(DOWNLOAD_DIR):
-        shutil.rmtree(DOWNLOAD_DIR, ignore_errors=True)
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    # empty the dir in place (keeps the dir for downloads running right now)
+    try:
+        with os.scandir(DOWNLOAD_DIR) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    clear_info_cache()
 
 def estimate_filesize_bytes(fmt, duration):
     fs = fmt.get("filesize") or fmt.get("filesize_approx")
@@ -112,27 +187,257 @@ def estimate_filesize_bytes(fmt, duration):
         return int((tbr * 1000 * duration) / 8)
     return None
 
-def is_url(text: str) -> bool:
-    return bool(text and URL_RE.search(text))
+def find_url(text: str):
+    # cheap C-level substring search first: most chat messages have no link
+    i = text.find("://") if text else -1
+    if i < 0:
+        return None
+    # start the regex at the scheme ("https" = 5 chars before "://"), not at 0
+    m = URL_RE.search(text, max(0, i - 5))
+    return m.group(1).strip() if m else None
+
+def is_supported_url(url: str) -> bool:
+    try:
+        parts = (urlsplit(url).hostname or "").split(".")
+    except ValueError:
+        # e.g. "https://[abc/x" -> Invalid IPv6 URL
+        return False
+    return any(".".join(parts[i:]) in SUPPORTED_DOMAINS for i in range(len(parts) - 1))
 
 def safe_remove(path):
     try:
         if path and os.path.exists(path):
             os.remove(path)
-    except:
-        pass
+    except OSError:
+        logger.warning("could not remove %s", path, exc_info=True)
+
+# =======================
+# Sessions (per scanned message)
+# =======================
+class Session:
+    # sizes are already baked into the button labels -> not kept here
+    __slots__ = ("url", "title", "duration", "q_to_fmt", "audio_fmt_id", "created")
+
+    def __init__(self, url, title="", duration=0, q_to_fmt=None, audio_fmt_id=None, created=None):
+        self.url = url
+        self.title = title
+        self.duration = duration
+        self.q_to_fmt = q_to_fmt or {}
+        self.audio_fmt_id = audio_fmt_id
+        # wall clock (not monotonic) -> still valid after a restart when persisted
+        self.created = created if created is not None else time.time()
+
+    def to_json(self):
+        return json.dumps({
+            "url": self.url,
+            "title": self.title,
+            "duration": self.duration,
+            "q_to_fmt": self.q_to_fmt,
+            "audio_fmt_id": self.audio_fmt_id,
+        })
+
+    @classmethod
+    def from_json(cls, data, created):
+        d = json.loads(data)
+        return cls(
+            d["url"],
+            title=d.get("title", ""),
+            duration=d.get("duration") or 0,
+            q_to_fmt={int(q): fmt_id for q, fmt_id in (d.get("q_to_fmt") or {}).items()},
+            audio_fmt_id=d.get("audio_fmt_id"),
+            created=created,
+        )
+
+_state_db = None
+if STATE_DB:
+    _state_db = sqlite3.connect(STATE_DB, check_same_thread=False)
+    _state_db.execute("PRAGMA journal_mode=WAL")
+    _state_db.execute(
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        "chat_id INTEGER, msg_id INTEGER, created REAL, data TEXT, "
+        "PRIMARY KEY (chat_id, msg_id))"
+    )
+    _state_db.commit()
+
+def _db_put(key, session):
+    _state_db.execute(
+        "INSERT OR REPLACE INTO sessions (chat_id, msg_id, created, data) VALUES (?, ?, ?, ?)",
+        (key[0], key[1], session.created, session.to_json()),
+    )
+    _state_db.execute("DELETE FROM sessions WHERE created < ?", (time.time() - SESSION_TTL_SEC,))
+    _state_db.commit()
+
+def _db_get(key):
+    row = _state_db.execute(
+        "SELECT created, data FROM sessions WHERE chat_id = ? AND msg_id = ?", key
+    ).fetchone()
+    return Session.from_json(row[1], row[0]) if row else None
+
+def state_put(key, session):
+    with _state_lock:
+        STATE[key] = session
+        STATE.move_to_end(key)
+        # evict least recently used -> no unbounded growth on long uptime
+        while len(STATE) > MAX_SESSIONS:
+            STATE.popitem(last=False)
+        if _state_db:
+            _db_put(key, session)
+
+def state_get(key):
+    with _state_lock:
+        st = STATE.get(key)
+        if st is None and _state_db:
+            # restarted / other worker scanned it -> no rescan needed
+            st = _db_get(key)
+            if st is not None:
+                STATE[key] = st
+        if st is None:
+            return None
+        if time.time() - st.created > SESSION_TTL_SEC:
+            del STATE[key]
+            return None
+        STATE.move_to_end(key)
+        return st
 
 # =======================
 # yt-dlp: extract info
 # =======================
+# shared on-disk cache: player JS / signature functions are reused across
+# scans and threads instead of being fetched+parsed per video
+YDL_BASE_OPTS = {
+    "quiet": True,
+    "noplaylist": True,
+    "cachedir": YDL_CACHE_DIR,
+}
+
+# Lean scan: only need formats list (height/ext/codecs/size) for the buttons.
+# YouTube adaptive https formats come from the player response, so skipping
+# the DASH/HLS manifests doesn't lose qualities, just extra requests.
+# "webpage" skip -> no ~1MB watch-page HTML; the InnerTube player/next API
+# JSON is used directly.
+SCAN_OPTS = {
+    **YDL_BASE_OPTS,
+    "skip_download": True,
+    "socket_timeout": 8,
+    "youtube_include_dash_manifest": False,
+    "youtube_include_hls_manifest": False,
+    "extractor_args": {
+        "youtube": {
+            "skip": ["dash", "hls", "translated_subs"],
+            "player_skip": ["configs", "webpage"],
+        },
+    },
+}
+
+# One long-lived YoutubeDL per thread (scan + download) -> extractors are set up
+# once and the HTTP connection pool (TLS sessions) stays warm between jobs,
+# without serializing scans behind a lock.
+_ydl_local = threading.local()
+
+def get_scan_ydl():
+    ydl = getattr(_ydl_local, "scan", None)
+    if ydl is None:
+        ydl = _ydl_local.scan = yt_dlp.YoutubeDL(SCAN_OPTS)
+    return ydl
+
 def extract_info(url: str):
-    opts = {
-        "quiet": True,
-        "noplaylist": True,
-        "skip_download": True,
-    }
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        return ydl.extract_info(url, download=False)
+    return get_scan_ydl().extract_info(url, download=False)
+
+def prewarm():
+    try:
+        extract_info(PREWARM_URL)
+    except Exception:
+        # best-effort: first real scan just pays the cost instead
+        logger.warning("prewarm scan failed", exc_info=True)
+
+# =======================
+# yt-dlp: download instances
+# =======================
+def _dl_progress_hook(d):
+    tracker = getattr(_ydl_local, "tracker", None)
+    if tracker:
+        tracker.hook(d)
+
+def get_download_ydl(outtmpl, fmt, merge_output_format=None, tracker=None):
+    ydl = getattr(_ydl_local, "dl", None)
+    if ydl is None:
+        ydl = _ydl_local.dl = yt_dlp.YoutubeDL({
+            **YDL_BASE_OPTS,
+            "progress_hooks": [_dl_progress_hook],
+            # HLS/DASH (X, Facebook, ...): fetch fragments in parallel so network
+            # reads overlap with disk writes instead of one fragment at a time
+            "concurrent_fragment_downloads": FRAGMENT_THREADS,
+            # start with 64 KiB reads/writes (yt-dlp grows it from 1 KiB otherwise)
+            "buffersize": 1 << 16,
+        })
+    # per-job options (format selector / outtmpl are parsed at init, so set them directly)
+    ydl.params["outtmpl"]["default"] = outtmpl
+    ydl.params["merge_output_format"] = merge_output_format
+    ydl.format_selector = ydl.build_format_selector(fmt)
+    _ydl_local.tracker = tracker
+    return ydl
+
+# =======================
+# yt-dlp: info cache
+# =======================
+# canonical url -> (ts, info), LRU-bounded
+_info_cache = OrderedDict()
+_info_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=1024)
+def canonical_url(url: str) -> str:
+    """
+    Cache key for a link:
+    YouTube (watch / youtu.be / shorts / embed / live) -> https://www.youtube.com/watch?v=<id>
+    else lowercase scheme/host, drop tracking params (utm_*, si, feature) and #fragment.
+    """
+    parts = urlsplit(url)
+    if (parts.hostname or "") in YOUTUBE_HOSTS:
+        m = YT_ID_RE.search(url)
+        if m:
+            return f"https://www.youtube.com/watch?v={m.group(1)}"
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.startswith("utm_") and k not in TRACKING_PARAMS
+    ]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+def get_info_cached(url: str):
+    info = cached_info(url)
+    if info is not None:
+        return info
+
+    key = canonical_url(url)
+    now = time.time()
+    info = slim_info(extract_info(url))
+    with _info_cache_lock:
+        # drop expired + least recently used entries -> bounded memory
+        for k in [k for k, (ts, _) in _info_cache.items() if now - ts > INFO_CACHE_TTL_SEC]:
+            del _info_cache[k]
+        _info_cache[key] = (now, info)
+        while len(_info_cache) > INFO_CACHE_MAX:
+            _info_cache.popitem(last=False)
+    return info
+
+def slim_info(info):
+    for k in INFO_DROP_KEYS:
+        info.pop(k, None)
+    return info
+
+def cached_info(url: str):
+    """Fresh cached info for a link (marked recently used), None on miss/expiry."""
+    key = canonical_url(url)
+    with _info_cache_lock:
+        hit = _info_cache.get(key)
+        if hit:
+            _info_cache.move_to_end(key)
+    if hit and time.time() - hit[0] <= INFO_CACHE_TTL_SEC:
+        return hit[1]
+    return None
+
+def clear_info_cache():
+    with _info_cache_lock:
+        _info_cache.clear()
 
 # =======================
 # Build choices
@@ -166,36 +471,29 @@ def build_video_choices(info):
         if est:
             q_sizes[q] = max(q_sizes.get(q, 0) or 0, est)
 
-    # 1) MP4 progressive (v+a)
+    # single pass: classify into tiers, then only the first usable tier is considered
+    progressive, mp4_video, other_video = [], [], []
     for f in formats:
-        if f.get("ext") != "mp4":
-            continue
-        if f.get("vcodec") == "none":
+        get = f.get
+        if get("vcodec") == "none":
             continue
-        if f.get("acodec") == "none":
-            continue
-        consider(f)
-
-    # 2) MP4 video-only
-    if not q_to_fmt:
-        for f in formats:
-            if f.get("ext") != "mp4":
-                continue
-            if f.get("vcodec") == "none":
-                continue
-            if f.get("acodec") != "none":
-                continue
+        ext = get("ext")
+        if get("acodec") != "none":
+            # 1) MP4 progressive (v+a)
+            if ext == "mp4":
+                progressive.append(f)
+        elif ext == "mp4":
+            # 2) MP4 video-only
+            mp4_video.append(f)
+        elif ext in ("webm", "mkv"):
+            # 3) fallback webm/mkv video-only
+            other_video.append(f)
+
+    for tier in (progressive, mp4_video, other_video):
+        for f in tier:
             consider(f)
-
-    # 3) fallback webm/mkv video-only
-    if not q_to_fmt:
-        for f in formats:
-            if f.get("vcodec") == "none":
-                continue
-            if f.get("acodec") != "none":
-                continue
-            if f.get("ext") in ("webm", "mkv"):
-                consider(f)
+        if q_to_fmt:
+            break
 
     qs = sorted(q_to_fmt.keys())
     return qs, q_to_fmt, q_sizes
@@ -217,6 +515,52 @@ def pick_audio_choice(info):
             return f.get("format_id")
     return None
 
+_probe_session = requests.Session()
+
+def probe_size(fmt):
+    """Content-Length of a direct (http/https) media url via HEAD, None if unknown."""
+    if fmt.get("protocol") not in ("http", "https") or not fmt.get("url"):
+        return None
+    try:
+        r = _probe_session.head(
+            fmt["url"], headers=fmt.get("http_headers"),
+            timeout=PROBE_TIMEOUT_SEC, allow_redirects=True,
+        )
+        if not r.ok:
+            # 403/404/405 -> Content-Length is the error page, not the media
+            return None
+        return int(r.headers.get("Content-Length") or 0) or None
+    except (requests.RequestException, ValueError):
+        return None
+
+def fill_missing_sizes(info, q_to_fmt, q_sizes):
+    """
+    Qualities with no filesize/tbr from yt-dlp show "??MB".
+    HEAD their formats concurrently -> one round trip instead of one per quality.
+    """
+    by_id = {f.get("format_id"): f for f in info.get("formats") or []}
+    missing = [q for q, fmt_id in q_to_fmt.items() if not q_sizes.get(q) and fmt_id in by_id]
+    if not missing:
+        return
+    sizes = PROBE_POOL.map(lambda q: probe_size(by_id[q_to_fmt[q]]), missing)
+    for q, size in zip(missing, sizes):
+        if size:
+            q_sizes[q] = size
+
+def scan_choices(info):
+    """
+    Video + audio choices (and quality button labels) for a scanned link,
+    computed once per (cached) info.
+    Stored under a "__" key -> yt-dlp drops it when the info is reused for download.
+    """
+    choices = info.get("__choices")
+    if choices is None:
+        qs, q_to_fmt, q_sizes = build_video_choices(info)
+        fill_missing_sizes(info, q_to_fmt, q_sizes)
+        labels = {q: VIDEO_BTN_TEMPLATES[q].format(fmt_mb(q_sizes.get(q))) for q in qs}
+        choices = info["__choices"] = (qs, q_to_fmt, pick_audio_choice(info), labels)
+    return choices
+
 # =======================
 # Progress tracking
 # =======================
@@ -224,22 +568,26 @@ class ProgressTracker:
     def __init__(self, chat_id, status_msg_id, title=""):
         self.chat_id = chat_id
         self.status_msg_id = status_msg_id
-        self.last_edit = 0
+        self._next_edit_at = 0.0
         self.last_text = ""
         self.title = title[:60] if title else ""
 
     def hook(self, d):
         if d.get("status") != "downloading":
             return
+        # called per chunk -> bail out before any formatting while throttled
+        now = time.monotonic()
+        if now < self._next_edit_at:
+            return
+
         total = d.get("total_bytes") or d.get("total_bytes_estimate")
         downloaded = d.get("downloaded_bytes") or 0
         if not total:
             return
+        # throttle whether the edit below succeeds, fails or is skipped as unchanged
+        self._next_edit_at = now + PROGRESS_EDIT_SECONDS
 
         pct = (downloaded / total) * 100
-        now = time.time()
-        if now - self.last_edit < PROGRESS_EDIT_SECONDS:
-            return
 
         bar = progress_bar(pct)
         spd = d.get("speed") or 0
@@ -258,117 +606,126 @@ class ProgressTracker:
             try:
                 bot.edit_message_text(text, self.chat_id, self.status_msg_id)
                 self.last_text = text
-                self.last_edit = now
-            except:
-                pass
+            except apihelper.ApiException:
+                # rate limit / message gone: skip this update, retry after the throttle
+                logger.debug("progress edit failed", exc_info=True)
 
 # =======================
 # Sending
 # =======================
-def send_with_limit(chat_id, file_path, kind):
-    size_mb = os.path.getsize(file_path) / (1024 * 1024)
-    if size_mb > MAX_FILE_MB:
-        bot.send_message(chat_id, f"❌ FILE TOO BIG: {size_mb:.1f}MB\n✅ اختار جودة أقل أو Audio.")
-        return False
+# one keep-alive pool to api.telegram.org for every thread (handlers, scans,
+# downloads); connection failures are retried with backoff
+_tg_session = requests.Session()
+_tg_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=HANDLER_THREADS + SCAN_THREADS + MAX_ACTIVE_JOBS,
+    max_retries=Retry(total=3, backoff_factor=0.3),
+))
+
+def tg_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    """
+    telebot request hook (apihelper.CUSTOM_REQUEST_SENDER).
+    Uploads are streamed from disk via MultipartEncoder; plain requests would
+    build the whole multipart body (= whole video) in memory first.
+    """
+    if not files:
+        return _tg_session.request(method, url, params=params, timeout=timeout, proxies=proxies)
+
+    fields = {}
+    for key, val in files.items():
+        if isinstance(val, tuple):
+            fields[key] = val
+        else:
+            fields[key] = (os.path.basename(getattr(val, "name", key)), val)
+    body = MultipartEncoder(fields=fields)
+    return _tg_session.request(
+        method, url, params=params, data=body,
+        headers={"Content-Type": body.content_type},
+        timeout=timeout, proxies=proxies,
+    )
+
+apihelper.CUSTOM_REQUEST_SENDER = tg_request_sender
 
-    if kind == "audio":
-        with open(file_path, "rb") as f:
+def send_with_limit(chat_id, file_path, kind):
+    # single open + fstat; big buffer -> ~1 read() syscall per MiB during upload
+    with open(file_path, "rb", buffering=UPLOAD_BUFFER_BYTES) as f:
+        size_mb = os.fstat(f.fileno()).st_size / (1024 * 1024)
+        if size_mb > MAX_FILE_MB:
+            bot.send_message(chat_id, f"❌ FILE TOO BIG: {size_mb:.1f}MB\n✅ اختار جودة أقل أو Audio.")
+            return False
+
+        if kind == "audio":
             bot.send_audio(chat_id, f)
-    else:
-        with open(file_path, "rb") as f:
+        else:
             bot.send_video(chat_id, f)
     return True
 
 # =======================
 # Job queue worker
 # =======================
-def _ensure_queue_worker():
-    global _queue_worker_started
-    if _queue_worker_started:
-        return
-    _queue_worker_started = True
-    t = threading.Thread(target=_queue_loop, daemon=True)
-    t.start()
-
-def _queue_loop():
-    while True:
-        job = None
-        with _queue_lock:
-            if _queue:
-                job = _queue.popleft()
-
-        if not job:
-            time.sleep(0.2)
-            continue
-
-        _active_sem.acquire()
-        try:
-            job()
-        finally:
-            _active_sem.release()
+def _log_job_failure(fut):
+    # errors raised outside run_download's try (INIT send, state db, error edit)
+    exc = fut.exception()
+    if exc is not None:
+        logger.error("download job failed", exc_info=exc)
 
 def enqueue(job_callable):
-    _ensure_queue_worker()
-    with _queue_lock:
-        _queue.append(job_callable)
+    POOL.submit(job_callable).add_done_callback(_log_job_failure)
 
 # =======================
 # Downloader worker
 # =======================
 def run_download(chat_id, origin_msg_id, mode, fmt_id=None):
     status = bot.send_message(chat_id, "⛓️ INIT...")
-    st = STATE.get((chat_id, origin_msg_id))
+    st = state_get((chat_id, origin_msg_id))
     if not st:
         bot.edit_message_text("❌ SESSION EXPIRED. SEND LINK AGAIN.", chat_id, status.message_id)
         return
 
-    url = st["url"]
-    title = st.get("title", "")
+    url = st.url
+    title = st.title
 
     tracker = ProgressTracker(chat_id, status.message_id, title=title)
     ts = int(time.time())
     outtmpl = os.path.join(DOWNLOAD_DIR, f"%(title).80s_{ts}.%(ext)s")
 
-    base_opts = {
-        "quiet": True,
-        "noplaylist": True,
-        "outtmpl": outtmpl,
-        "progress_hooks": [tracker.hook],
-    }
-
     try:
         if mode == "audio":
-            # prefer a known m4a/mp4 audio id if available; else bestaudio
-            a_fmt = st.get("audio_fmt_id")
-            fmt = a_fmt if a_fmt else "bestaudio/best"
-            opts = {
-                **base_opts,
-                "format": fmt,
-            }
+            # prefer a known m4a/mp4 audio id if available; else bestaudio (m4a first)
+            # no FFmpegExtractAudio -> audio is sent as-is, never transcoded
+            a_fmt = st.audio_fmt_id
+            fmt = a_fmt if a_fmt else "bestaudio[ext=m4a]/bestaudio/best"
+            merge_fmt = None
         else:
             if not fmt_id:
                 bot.edit_message_text("❌ PICK A QUALITY BUTTON FIRST.", chat_id, status.message_id)
                 return
 
-            # Try progressive format first; if needs audio merge, do fmt_id+bestaudio
+            # fmt_id+bestaudio: progressive fmt_id -> yt-dlp drops the extra audio and
+            # downloads it as-is; video-only -> merged with audio (m4a preferred, so
+            # ffmpeg only remuxes mp4+m4a with -c copy, no re-encode, no Python work)
             # Requires ffmpeg for merging (installed via nixpacks.toml)
-            opts = {
-                **base_opts,
-                "format": f"{fmt_id}/{fmt_id}+bestaudio/best",
-                "merge_output_format": "mp4",
-            }
+            fmt = f"{fmt_id}+bestaudio[ext=m4a]/{fmt_id}+bestaudio/{fmt_id}/best"
+            merge_fmt = "mp4"
 
         bot.edit_message_text("⏳ STARTING DOWNLOAD...", chat_id, status.message_id)
 
-        with yt_dlp.YoutubeDL(opts) as ydl:
+        # reuse the scan result -> no second metadata pass (same as --load-info-json)
+        cached = get_info_cached(url)
+        ydl = get_download_ydl(outtmpl, fmt, merge_fmt, tracker)
+        try:
+            info = ydl.process_ie_result(ydl.sanitize_info(cached, remove_private_keys=True), download=True)
+        except yt_dlp.utils.DownloadError:
+            # media urls expired / rejected -> fresh extraction
             info = ydl.extract_info(url, download=True)
-            file_path = ydl.prepare_filename(info)
+        file_path = ydl.prepare_filename(info)
 
         ok = send_with_limit(chat_id, file_path, "audio" if mode == "audio" else "video")
         bot.edit_message_text("✅ DONE." if ok else "⚠️ DOWNLOADED BUT NOT SENT.", chat_id, status.message_id)
         safe_remove(file_path)
 
     except Exception as e:
+        logger.exception("download failed: %s (%s)", url, mode)
         bot.edit_message_text(f"❌ ERROR: {type(e).__name__}", chat_id, status.message_id)
 
 # =======================
@@ -389,6 +746,13 @@ def hacker_menu():
     )
     return kb
 
+# static -> build once (telebot serializes via to_json(), reuse is safe)
+HACKER_MENU = hacker_menu()
+
+AUDIO_BTN_TEXT = "🎧 AUDIO (M4A)"
+# quality -> button label template, only the size is filled in per scan
+VIDEO_BTN_TEMPLATES = {q: f"🎥 {q}p  [{{}}]" for q in QUALITY_BUCKETS}
+
 @bot.message_handler(commands=["start"])
 def cmd_start(message):
     text = (
@@ -401,7 +765,7 @@ def cmd_start(message):
         "━━━━━━━━━━━━━━━━━━\n"
         "Send a link ↓"
     )
-    bot.send_message(message.chat.id, text, reply_markup=hacker_menu())
+    bot.send_message(message.chat.id, text, reply_markup=HACKER_MENU)
 
 @bot.message_handler(commands=["help"])
 def cmd_help(message):
@@ -414,6 +778,7 @@ def cmd_help(message):
         "/start - menu\n"
         "/help - guide\n"
         "/cleanup - delete files\n"
+        "/cleancache - forget scanned links\n"
         "/setminq 360|480|720 - change min quality"
     )
 
@@ -422,6 +787,11 @@ def cmd_cleanup(message):
     clean_downloads()
     bot.reply_to(message, "🧹 CLEANED. downloads/ is empty.")
 
+@bot.message_handler(commands=["cleancache"])
+def cmd_cleancache(message):
+    clear_info_cache()
+    bot.reply_to(message, "🧹 CACHE CLEARED. links will be rescanned.")
+
 @bot.message_handler(commands=["setminq"])
 def cmd_setminq(message):
     global MIN_QUALITY_P
@@ -436,9 +806,15 @@ def cmd_setminq(message):
     MIN_QUALITY_P = v
     bot.reply_to(message, f"✅ MIN QUALITY SET TO {MIN_QUALITY_P}p")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("menu_"))
+def answer_query(call, text=None):
+    # stale taps ("query is too old") must not escape into telebot's worker pool
+    try:
+        bot.answer_callback_query(call.id, text)
+    except apihelper.ApiException:
+        logger.warning("answer_callback_query failed", exc_info=True)
+
 def menu_cb(call):
-    bot.answer_callback_query(call.id)
+    answer_query(call)
     cid = call.message.chat.id
     if call.data == "menu_help":
         bot.send_message(cid, "Send link → choose quality → download.\nUse /setminq to save space.")
@@ -455,107 +831,154 @@ def menu_cb(call):
 # =======================
 # Link handler
 # =======================
-@bot.message_handler(func=lambda m: is_url(m.text))
+# catch-all for text (commands are registered above and match first);
+# the link is found with one regex pass instead of filter + handler
+@bot.message_handler(content_types=["text"])
 def on_url(message):
-    url = URL_RE.search(message.text).group(1).strip()
+    url = find_url(message.text)
+    if not url:
+        return
+    if not is_supported_url(url):
+        bot.reply_to(message, f"❌ UNSUPPORTED DOMAIN\n📌 Supported: {SUPPORTED_HINT}")
+        return
+    # cached link -> choices come back at once: no pool, no SCANNING round trip
+    info = cached_info(url)
+    if info is not None:
+        show_choices(message, url, lambda: info)
+        return
+    # start the scan right away -> the SCANNING reply round-trip overlaps with it;
+    # the handler returns now, choices are posted when the scan completes.
+    scan = SCAN_POOL.submit(get_info_cached, url)
     bot.reply_to(message, "🔎 SCANNING...")
+    scan.add_done_callback(lambda fut: show_choices(message, url, fut.result))
 
+def show_choices(message, url, get_info):
     try:
-        info = extract_info(url)
+        info = get_info()
 
         title = info.get("title", "NO_TITLE")
         duration = info.get("duration") or 0
         uploader = info.get("uploader") or info.get("channel") or "UNKNOWN"
+        dur_label = fmt_dur(duration)
 
         if duration and duration > MAX_DURATION_SEC:
-            bot.reply_to(message, f"❌ TOO LONG: {fmt_dur(duration)} (MAX 3h)")
+            bot.reply_to(message, f"❌ TOO LONG: {dur_label} (MAX 3h)")
             return
 
-        qs, q_to_fmt, q_sizes = build_video_choices(info)
+        qs, q_to_fmt, audio_fmt_id, labels = scan_choices(info)
         qs_shown = [q for q in qs if q >= MIN_QUALITY_P]
 
-        audio_fmt_id = pick_audio_choice(info)
-
-        text_lines = [
-            "🧾 TARGET LOCKED:",
-            f"• TITLE: {title}",
-            f"• SRC: {uploader}",
-            f"• DUR: {fmt_dur(duration)}",
-            "",
+        text = (
+            "🧾 TARGET LOCKED:\n"
+            f"• TITLE: {title}\n"
+            f"• SRC: {uploader}\n"
+            f"• DUR: {dur_label}\n"
+            "\n"
             f"🎬 PICK QUALITY (>= {MIN_QUALITY_P}p):"
-        ]
+        )
 
-        kb = telebot.types.InlineKeyboardMarkup(row_width=1)
+        # 2 quality buttons per row -> half the keyboard height
+        kb = telebot.types.InlineKeyboardMarkup(row_width=2)
 
         if qs_shown:
-            for q in qs_shown:
-                kb.add(
-                    telebot.types.InlineKeyboardButton(
-                        f"🎥 {q}p  [{fmt_mb(q_sizes.get(q))}]",
-                        callback_data=f"v|{message.chat.id}|{message.message_id}|{q}"
-                    )
-                )
+            # callback_data: "v|<msg_id>|<q>" (chat id comes with the callback itself)
+            cb_prefix = f"v|{message.message_id}|"
+            kb.add(*[
+                telebot.types.InlineKeyboardButton(labels[q], callback_data=f"{cb_prefix}{q}")
+                for q in qs_shown
+            ])
         else:
-            text_lines.append("⚠️ NO QUALITIES FOUND FOR THIS LINK.")
-            text_lines.append("Try another link or use AUDIO.")
+            text += "\n⚠️ NO QUALITIES FOUND FOR THIS LINK.\nTry another link or use AUDIO."
 
         kb.add(
             telebot.types.InlineKeyboardButton(
-                "🎧 AUDIO (M4A)",
-                callback_data=f"a|{message.chat.id}|{message.message_id}|0"
+                AUDIO_BTN_TEXT,
+                callback_data=f"a|{message.message_id}"
             )
         )
 
-        bot.send_message(message.chat.id, "\n".join(text_lines), reply_markup=kb)
+        # session first -> a fast tap on a fresh button never sees "expired"
+        state_put((message.chat.id, message.message_id), Session(
+            url,
+            title=title,
+            duration=duration,
+            q_to_fmt=q_to_fmt,
+            audio_fmt_id=audio_fmt_id,
+        ))
 
-        STATE[(message.chat.id, message.message_id)] = {
-            "url": url,
-            "title": title,
-            "duration": duration,
-            "q_to_fmt": q_to_fmt,
-            "q_sizes": q_sizes,
-            "audio_fmt_id": audio_fmt_id,
-        }
+        bot.send_message(message.chat.id, text, reply_markup=kb)
 
     except Exception as e:
+        logger.exception("scan failed: %s", url)
         bot.reply_to(message, f"❌ SCAN FAILED: {type(e).__name__}\nMake sure the link is public.")
 
 # =======================
 # Download buttons
 # =======================
-@bot.callback_query_handler(func=lambda call: call.data.startswith(("v|", "a|")))
 def dl_cb(call):
+    # "v|<msg_id>|<q>" / "a|<msg_id>" -> buttons live in the same chat as the link
+    kind, _, rest = call.data.partition("|")
+    mid_s, _, q_s = rest.partition("|")
+    chat_id = call.message.chat.id
     try:
-        parts = call.data.split("|")
-        kind = parts[0]  # v / a
-        chat_id = int(parts[1])
-        msg_id = int(parts[2])
-        q = int(parts[3])
-
-        st = STATE.get((chat_id, msg_id))
-        if not st:
-            bot.answer_callback_query(call.id, "SESSION EXPIRED. SEND LINK AGAIN.")
-            return
-
-        bot.answer_callback_query(call.id, "⏳ QUEUED...")
+        msg_id = int(mid_s)
+        q = int(q_s) if kind == "v" else 0
+    except ValueError:
+        logger.warning("malformed callback data: %r", call.data)
+        answer_query(call, "ERROR")
+        return
 
-        if kind == "a":
-            enqueue(lambda: run_download(chat_id, msg_id, "audio", None))
-            return
+    st = state_get((chat_id, msg_id))
+    if not st:
+        answer_query(call, "SESSION EXPIRED. SEND LINK AGAIN.")
+        return
 
-        if kind == "v":
-            fmt_id = st["q_to_fmt"].get(q)
-            if not fmt_id:
-                bot.answer_callback_query(call.id, "QUALITY NOT AVAILABLE. SEND LINK AGAIN.")
-                return
-            enqueue(lambda: run_download(chat_id, msg_id, "video", fmt_id))
-            return
+    if kind == "a":
+        answer_query(call, "⏳ QUEUED...")
+        enqueue(lambda: run_download(chat_id, msg_id, "audio", None))
+        return
 
-    except:
-        try:
-            bot.answer_callback_query(call.id, "ERROR")
-        except:
-            pass
+    fmt_id = st.q_to_fmt.get(q)
+    if not fmt_id:
+        answer_query(call, "QUALITY NOT AVAILABLE. SEND LINK AGAIN.")
+        return
+    answer_query(call, "⏳ QUEUED...")
+    enqueue(lambda: run_download(chat_id, msg_id, "video", fmt_id))
 
-print("Bot running...", flush=True)
-bot.infinity_polling()
+# =======================
+# Callback router
+# =======================
+# one handler + dict lookup instead of a filter lambda per handler
+CALLBACK_ROUTES = {
+    "v": dl_cb,
+    "a": dl_cb,
+    "menu_help": menu_cb,
+    "menu_settings": menu_cb,
+    "menu_video": menu_cb,
+    "menu_audio": menu_cb,
+    "menu_cleanup": menu_cb,
+}
+
+@bot.callback_query_handler(func=lambda call: True)
+def on_callback(call):
+    handler = CALLBACK_ROUTES.get((call.data or "").split("|", 1)[0])
+    if handler:
+        handler(call)
+
+if __name__ == "__main__":
+    # single entrypoint: importing bot.py must never start a second poller
+    SCAN_POOL.submit(prewarm)
+
+    if WEBHOOK_URL:
+        # Telegram pushes updates -> no getUpdates long-poll round trips
+        logger.info("Bot running (webhook)...")
+        bot.run_webhooks(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=f"{TOKEN}/",
+            webhook_url=f"{WEBHOOK_URL}/{TOKEN}/",
+        )
+    else:
+        bot.remove_webhook()  # polling fails with 409 while a webhook is still set
+        logger.info("Bot running...")
+        bot.infinity_polling()